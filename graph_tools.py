@@ -1,5 +1,41 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+import httpx
+import orjson
 import requests
 
+from http_retry import RETRY_MAX_DELAY, RETRY_STATUS_CODES
+
+logger = logging.getLogger(__name__)
+
+# Session for the synchronous token requests to login.microsoftonline.com, made about once an hour
+TOKEN_SESSION = requests.Session()
+
+# Base URL of the shared HTTP client; the Graph helpers below only pass paths relative to it
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+
+# Attempts for sub-requests that come back throttled or failed inside a $batch response
+GRAPH_BATCH_MAX_ATTEMPTS = 5
+
+# Page size requested when listing folder children
+GRAPH_PAGE_SIZE = 999
+
+# Maximum number of sub-requests Graph accepts in a single $batch call
+GRAPH_BATCH_LIMIT = 20
+
+# Refresh the cached token this many seconds before it actually expires
+TOKEN_REFRESH_BUFFER = 300
+
+def _json(response) -> dict:
+    # orjson parses the large Graph listings several times faster than the stdlib json module
+    return orjson.loads(response.content)
+
 class AzureAuth:
     """
     Authenticate with Azure Active Directory using OAuth2 and obtain an access token.
@@ -9,6 +45,9 @@ class AzureAuth:
     client_id (str): The client ID for the application.
     client_secret (str): The client secret for the application.
     resource (str): The resource for the application.
+
+    Tokens are cached in memory and only re-minted when they are close to expiry,
+    so a single instance should be shared rather than constructed per request.
     """
     def __init__(self, tenant_id: str, client_id: str, client_secret: str):
         """
@@ -23,34 +62,46 @@ class AzureAuth:
         self.client_id = client_id
         self.client_secret = client_secret
         self.resource = 'https://graph.microsoft.com/.default'
+        self._token = None
+        self._expires_at = 0.0
+        self._lock = threading.Lock()
 
     def get_access_token(self) -> str:
         """
-        Get an access token for the Azure AD application.
+        Get an access token for the Azure AD application. Returns the cached token
+        unless it expires within TOKEN_REFRESH_BUFFER seconds, in which case a new one is minted.
 
         Returns:
             str: The access token.
         """
-        payload = {
-            'grant_type': 'client_credentials',
-            'client_id': self.client_id,
-            'client_secret': self.client_secret,
-            'scope': self.resource
-        }
-        response = requests.post(self.token_url, data=payload, headers={'Content-Type': 'application/x-www-form-urlencoded'})
-        if response.status_code == 200:
-            data = response.json()
-            with open('access_token.txt', 'w') as f:
-                f.write(data['access_token'])
-            return data['access_token']
-        else:
-            response.raise_for_status()
+        with self._lock:
+            if self._token and time.monotonic() < self._expires_at - TOKEN_REFRESH_BUFFER:
+                return self._token
+
+            payload = {
+                'grant_type': 'client_credentials',
+                'client_id': self.client_id,
+                'client_secret': self.client_secret,
+                'scope': self.resource
+            }
+            response = TOKEN_SESSION.post(self.token_url, data=payload, headers={'Content-Type': 'application/x-www-form-urlencoded'})
+            if response.status_code == 200:
+                data = _json(response)
+                self._token = data['access_token']
+                self._expires_at = time.monotonic() + int(data.get('expires_in', 0))
+                if os.getenv('DEBUG_PERSIST_TOKEN'):
+                    # Debugging aid only; callers already run this off the event loop
+                    Path('access_token.txt').write_text(self._token)
+                return self._token
+            else:
+                response.raise_for_status()
 
-def get_drive_id_by_library_name(site_id: str, library_name: str, access_token: str) -> str:
+async def get_drive_id_by_library_name(client: httpx.AsyncClient, site_id: str, library_name: str, access_token: str) -> str:
     """
     Get the drive ID for a given library name in a SharePoint site using Microsoft Graph API.
 
     Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
     site_id (str): The ID of the SharePoint site.
     library_name (str): The name of the library to get the drive ID for.
     access_token (str): The OAuth2 access token for Microsoft Graph API.
@@ -58,23 +109,25 @@ def get_drive_id_by_library_name(site_id: str, library_name: str, access_token:
     Returns:
     str: The drive ID for the library.
     """
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives"
+    url = f"/sites/{site_id}/drives"
     headers = {'Authorization': f'Bearer {access_token}', 'Content-Type': 'application/json'}
-    response = requests.get(url, headers=headers)
+    response = await client.get(url, headers=headers)
     response.raise_for_status()
-    data = response.json()
-    print("data: ", data)
+    data = _json(response)
+    logger.debug("Drives for site %s: %s", site_id, data)
     for drive in data['value']:
         if drive['name'] == library_name:
-            print("drive: ", drive)
+            logger.debug("Matched drive: %s", drive)
             return drive['id']
     raise ValueError("No drive found with the name:", library_name)
 
-def list_files_in_folder(site_id: str, drive_id: str, folder_id: str, access_token: str) -> dict:
+async def list_files_in_folder(client: httpx.AsyncClient, site_id: str, drive_id: str, folder_id: str, access_token: str) -> dict:
     """
     Lists files in a folder in a SharePoint document library using Microsoft Graph API.
+    Follows '@odata.nextLink' so folders with more children than fit in one page are listed in full.
 
     Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
     site_id (str): The ID of the SharePoint site.
     drive_id (str): The ID of the document library (considered as a drive).
     folder_id (str): The ID of the folder to list files in.
@@ -83,24 +136,75 @@ def list_files_in_folder(site_id: str, drive_id: str, folder_id: str, access_tok
     Returns:
     dict: A dictionary containing the list of files or an error message.
     """
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/items/{folder_id}/children"
+    url = f"/sites/{site_id}/drives/{drive_id}/items/{folder_id}/children"
+    params = {'$top': GRAPH_PAGE_SIZE, '$select': 'id,name,size,cTag,folder,parentReference'}
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
 
     try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raises an HTTPError for bad requests (4XX or 5XX)
-        return response.json()  # Returns the JSON response containing the list of files
-    except requests.exceptions.HTTPError as err:
-        return {'error': str(err), 'details': response.json()}
+        items = []
+        while url:
+            response = await client.get(url, headers=headers, params=params)
+            response.raise_for_status()  # Raises an HTTPError for bad requests (4XX or 5XX)
+            data = _json(response)
+            items.extend(data.get('value', []))
+            # The next link already carries the query string
+            url = data.get('@odata.nextLink')
+            params = None
+        return {'value': items}
+    except httpx.HTTPStatusError as err:
+        return {'error': str(err), 'details': _json(response)}
 
-def list_files_in_library(site_id: str, drive_id: str, access_token: str) -> dict:
+async def list_folder_tree(client: httpx.AsyncClient, site_id: str, drive_id: str, folder_id: str, folder_path: str, access_token: str, max_concurrency: int = 8) -> tuple:
+    """
+    Enumerate every descendant of a folder breadth first, listing the folders of each level concurrently.
+
+    Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
+    site_id (str): The ID of the SharePoint site.
+    drive_id (str): The ID of the document library (considered as a drive).
+    folder_id (str): The ID of the folder to walk.
+    folder_path (str): The path to report for the folder itself; descendants are reported below it.
+    access_token (str): The OAuth2 access token for Microsoft Graph API.
+    max_concurrency (int): Maximum number of folder listings in flight at once.
+
+    Returns:
+    tuple: A list of descendant folder paths, and a list of (folder path, file) pairs for every file.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def list_folder(level_folder_id: str) -> dict:
+        async with semaphore:
+            return await list_files_in_folder(client, site_id, drive_id, level_folder_id, access_token)
+
+    folders = []
+    files = []
+    level = [(folder_id, folder_path)]
+    while level:
+        listings = await asyncio.gather(*[list_folder(level_folder_id) for level_folder_id, _ in level])
+        next_level = []
+        for (_, path), listing in zip(level, listings):
+            if 'error' in listing:
+                raise ValueError(f"Error listing folder {path}: {listing['error']}")
+            for child in listing['value']:
+                child_path = f"{path}/{child['name']}"
+                if 'folder' in child:
+                    folders.append(child_path)
+                    if child['folder'].get('childCount', 0) > 0:
+                        next_level.append((child['id'], child_path))
+                else:
+                    files.append((path, child))
+        level = next_level
+    return folders, files
+
+async def list_files_in_library(client: httpx.AsyncClient, site_id: str, drive_id: str, access_token: str) -> dict:
     """
     Lists files in a SharePoint document library using Microsoft Graph API.
 
     Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
     site_id (str): The ID of the SharePoint site.
     drive_id (str): The ID of the document library (considered as a drive).
     access_token (str): The OAuth2 access token for Microsoft Graph API.
@@ -108,24 +212,25 @@ def list_files_in_library(site_id: str, drive_id: str, access_token: str) -> dic
     Returns:
     dict: A dictionary containing the list of files or an error message.
     """
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root/children"
+    url = f"/sites/{site_id}/drives/{drive_id}/root/children"
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = await client.get(url, headers=headers)
         response.raise_for_status()  # Raises an HTTPError for bad requests (4XX or 5XX)
-        return response.json()  # Returns the JSON response containing the list of files
-    except requests.exceptions.HTTPError as err:
-        return {'error': str(err), 'details': response.json()}
+        return _json(response)  # Returns the JSON response containing the list of files
+    except httpx.HTTPStatusError as err:
+        return {'error': str(err), 'details': _json(response)}
     
-def search_files_by_filename(site_id: str, drive_id: str, access_token: str, filename: str) -> dict:
+async def search_files_by_filename(client: httpx.AsyncClient, site_id: str, drive_id: str, access_token: str, filename: str) -> dict:
     """
     Search for files in a SharePoint document library by filename using Microsoft Graph API's search capability.
 
     Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
     site_id (str): The ID of the SharePoint site.
     drive_id (str): The ID of the document library (considered as a drive).
     access_token (str): The OAuth2 access token for Microsoft Graph API.
@@ -134,25 +239,28 @@ def search_files_by_filename(site_id: str, drive_id: str, access_token: str, fil
     Returns:
     dict: A dictionary containing the search results or an error message.
     """
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/root/search(q='{filename}')"
+    # Escape quotes for the OData string literal, then percent-encode it for the path
+    query = quote(filename.replace("'", "''"), safe='')
+    url = f"/sites/{site_id}/drives/{drive_id}/root/search(q='{query}')"
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
 
     try:
-        response = requests.get(url, headers=headers)
+        response = await client.get(url, headers=headers)
         response.raise_for_status()  # Raises an HTTPError for bad requests (4XX or 5XX)
-        return response.json()  # Returns the JSON response containing the search results
-    except requests.exceptions.HTTPError as err:
-        return {'error': str(err), 'details': response.json() if response.content else "No additional details available."}
+        return _json(response)  # Returns the JSON response containing the search results
+    except httpx.HTTPStatusError as err:
+        return {'error': str(err), 'details': _json(response) if response.content else "No additional details available."}
 
 
-def update_drive_item_metadata(site_id: str, drive_id: str, item_id: str, item_name: str, metadata: dict, access_token: str) -> dict:
+async def update_drive_item_metadata(client: httpx.AsyncClient, site_id: str, drive_id: str, item_id: str, item_name: str, metadata: dict, access_token: str) -> dict:
     """
     Update metadata for an item in a Microsoft OneDrive or SharePoint drive using the Microsoft Graph API.
 
     Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
     drive_id (str): The unique identifier for the drive.
     item_id (str): The unique identifier for the drive item to update.
     metadata (dict): A dictionary containing the metadata fields and values to update.
@@ -161,14 +269,8 @@ def update_drive_item_metadata(site_id: str, drive_id: str, item_id: str, item_n
     Returns:
     dict: The response from the Microsoft Graph API.
     """
-    # Check if search_files_by_filename function works correctly
-    print("Searching for files by filename:", search_files_by_filename(site_id, drive_id, access_token, item_name))
-    print("Item ID:", item_id)
-    
-    url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drives/{drive_id}/items/{item_id}/listItem/fields"
-    
-    print("URL:", url)
-    print("Metadata to update:", metadata)
+    url = f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/listItem/fields"
+    logger.debug("Updating metadata for %s: %s", url, metadata)
     
     headers = {
         'Content-Type': 'application/json',
@@ -176,19 +278,140 @@ def update_drive_item_metadata(site_id: str, drive_id: str, item_id: str, item_n
     }
     
     # Perform the PATCH request to update metadata
-    response = requests.patch(url, headers=headers, json=metadata)
+    response = await client.patch(url, headers=headers, content=orjson.dumps(metadata))
     
     if response.status_code == 200:
-        print("Metadata update successful")
-        return {'success': True, 'data': response.json()}
+        return {'success': True, 'data': _json(response)}
     else:
-        print("Metadata update failed")
-        print("Status code:", response.status_code)
         try:
-            error_response = response.json()
-            print("Error response:", error_response)
+            error_response = _json(response)
         except ValueError:
             error_response = response.text
-            print("Error response (non-JSON):", error_response)
-        
-        return {'success': False, 'error': error_response}
\ No newline at end of file
+        logger.debug("Metadata update failed with status %s: %s", response.status_code, error_response)
+        return {'success': False, 'error': error_response}
+
+
+async def graph_batch(client: httpx.AsyncClient, requests_list: list, access_token: str) -> dict:
+    """
+    Send requests to the Microsoft Graph API using JSON batching, in chunks of GRAPH_BATCH_LIMIT.
+
+    Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
+    requests_list (list): Sub-requests, each a dict with 'id', 'method' and 'url' (relative to /v1.0),
+        and optionally 'body' and 'headers'.
+    access_token (str): The OAuth2 access token for Microsoft Graph API.
+
+    Returns:
+    dict: The sub-responses keyed by sub-request id, each containing 'status', 'headers' and 'body'.
+    """
+    url = "/$batch"
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+
+    responses = {}
+    pending = requests_list
+    for attempt in range(1, GRAPH_BATCH_MAX_ATTEMPTS + 1):
+        chunks = [pending[start:start + GRAPH_BATCH_LIMIT] for start in range(0, len(pending), GRAPH_BATCH_LIMIT)]
+        batch_responses = await asyncio.gather(*[client.post(url, headers=headers, content=orjson.dumps({'requests': chunk})) for chunk in chunks])
+
+        # Graph throttles sub-requests individually, so resend just those, waiting as long
+        # as the longest Retry-After among them
+        retry_ids = set()
+        delay = 2 ** (attempt - 1)
+        for response in batch_responses:
+            response.raise_for_status()
+            for sub_response in _json(response).get('responses', []):
+                responses[sub_response['id']] = sub_response
+                if sub_response.get('status') in RETRY_STATUS_CODES:
+                    retry_ids.add(sub_response['id'])
+                    retry_after = sub_response.get('headers', {}).get('Retry-After', '')
+                    if retry_after.isdigit():
+                        delay = max(delay, min(int(retry_after), RETRY_MAX_DELAY))
+
+        pending = [request for request in pending if request['id'] in retry_ids]
+        if not pending or attempt == GRAPH_BATCH_MAX_ATTEMPTS:
+            break
+        logger.warning("Retrying %d throttled or failed batch sub-requests in %ds", len(pending), delay)
+        await asyncio.sleep(delay)
+    return responses
+
+
+async def get_drive_item_ctags(client: httpx.AsyncClient, site_id: str, items: list, access_token: str) -> list:
+    """
+    Get the cTag (content version) of several drive items with batched Microsoft Graph API requests.
+
+    Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
+    site_id (str): The ID of the SharePoint site.
+    items (list): Tuples of (drive_id, item_id) for each item.
+    access_token (str): The OAuth2 access token for Microsoft Graph API.
+
+    Returns:
+    list: The cTag of each item in the same order, or None where it couldn't be fetched.
+    """
+    batch_requests = [
+        {
+            'id': str(index),
+            'method': 'GET',
+            'url': f"/sites/{site_id}/drives/{drive_id}/items/{item_id}?$select=id,cTag"
+        }
+        for index, (drive_id, item_id) in enumerate(items)
+    ]
+    if not batch_requests:
+        return []
+
+    try:
+        responses = await graph_batch(client, batch_requests, access_token)
+    except httpx.HTTPError as e:
+        logger.error(f"Batched cTag lookup failed: {str(e)}")
+        return [None for _ in items]
+
+    ctags = []
+    for batch_request in batch_requests:
+        sub_response = responses.get(batch_request['id'], {})
+        ctags.append(sub_response.get('body', {}).get('cTag') if sub_response.get('status') == 200 else None)
+    return ctags
+
+
+async def update_drive_items_metadata(client: httpx.AsyncClient, site_id: str, updates: list, access_token: str) -> list:
+    """
+    Update metadata for several drive items with batched Microsoft Graph API requests.
+
+    Args:
+    client (httpx.AsyncClient): The shared HTTP client, with GRAPH_BASE_URL as its base URL.
+    site_id (str): The ID of the SharePoint site.
+    updates (list): Tuples of (drive_id, item_id, metadata) describing each update.
+    access_token (str): The OAuth access token with appropriate permissions.
+
+    Returns:
+    list: One result per update, in the same order, each a dict with 'success' and 'data' or 'error'.
+    """
+    batch_requests = [
+        {
+            'id': str(index),
+            'method': 'PATCH',
+            'url': f"/sites/{site_id}/drives/{drive_id}/items/{item_id}/listItem/fields",
+            'body': metadata,
+            'headers': {'Content-Type': 'application/json'}
+        }
+        for index, (drive_id, item_id, metadata) in enumerate(updates)
+    ]
+
+    try:
+        responses = await graph_batch(client, batch_requests, access_token)
+    except httpx.HTTPError as e:
+        logger.error(f"Batched metadata update failed: {str(e)}")
+        return [{'success': False, 'error': str(e)} for _ in updates]
+
+    results = []
+    for batch_request in batch_requests:
+        sub_response = responses.get(batch_request['id'], {})
+        if sub_response.get('status') == 200:
+            results.append({'success': True, 'data': sub_response.get('body')})
+        else:
+            logger.error(f"Metadata update failed for {batch_request['url']}: {sub_response.get('status')}")
+            logger.debug("Metadata update response: %s", sub_response)
+            results.append({'success': False, 'error': sub_response.get('body')})
+    return results
@@ -0,0 +1,113 @@
+import asyncio
+import email.utils
+import logging
+import time
+
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Graph throttling (429) and transient server-side failures worth retrying
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# Upper bound in seconds for any single wait between retries, including one asked for by Retry-After
+RETRY_MAX_DELAY = 120.0
+
+class _RetryPolicy:
+    """
+    Retry behaviour shared by the async and sync retrying transports. Retry-After is honoured
+    when the server sends it, otherwise retries back off exponentially.
+
+    Requests with a one-shot streamed body (e.g. a Graph download piped into an S3 PUT)
+    are sent once, since their body can't be replayed.
+
+    Attributes:
+    max_attempts (int): Total number of attempts per request, including the first.
+    backoff_factor (float): Delay in seconds before the first retry; doubles on each retry.
+    max_delay (float): Upper bound in seconds for any single wait, including Retry-After.
+    """
+    def __init__(self, transport, max_attempts: int = 5, backoff_factor: float = 0.5, max_delay: float = RETRY_MAX_DELAY):
+        """
+        Initialize the retry policy.
+
+        Args:
+            transport: The transport that actually sends requests.
+            max_attempts (int): Total number of attempts per request, including the first.
+            backoff_factor (float): Delay in seconds before the first retry.
+            max_delay (float): Upper bound in seconds for any single wait.
+        """
+        self._transport = transport
+        self.max_attempts = max_attempts
+        self.backoff_factor = backoff_factor
+        self.max_delay = max_delay
+
+    def _attempts(self, request: httpx.Request) -> int:
+        return self.max_attempts if isinstance(request.stream, httpx.ByteStream) else 1
+
+    def _backoff(self, attempt: int) -> float:
+        return min(self.backoff_factor * 2 ** (attempt - 1), self.max_delay)
+
+    def _retry_delay(self, response: httpx.Response, attempt: int) -> float:
+        retry_after = response.headers.get('Retry-After')
+        if retry_after:
+            # Retry-After is either a number of seconds or an HTTP date
+            try:
+                return min(max(float(retry_after), 0.0), self.max_delay)
+            except ValueError:
+                try:
+                    retry_at = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                    return min(max(retry_at - time.time(), 0.0), self.max_delay)
+                except (TypeError, ValueError):
+                    pass
+        return self._backoff(attempt)
+
+class RetryTransport(_RetryPolicy, httpx.AsyncBaseTransport):
+    """
+    Wrap an async httpx transport so throttled and transient server errors are retried on
+    the same pooled connections.
+    """
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempts = self._attempts(request)
+        for attempt in range(1, attempts + 1):
+            try:
+                response = await self._transport.handle_async_request(request)
+            except httpx.ConnectError:
+                if attempt == attempts:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Connection to %s failed, retrying in %.1fs (attempt %d of %d)", request.url.host, delay, attempt, attempts)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                    return response
+                delay = self._retry_delay(response, attempt)
+                await response.aclose()
+                logger.warning("%s %s returned %d, retrying in %.1fs (attempt %d of %d)", request.method, request.url.path, response.status_code, delay, attempt, attempts)
+            await asyncio.sleep(delay)
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+class SyncRetryTransport(_RetryPolicy, httpx.BaseTransport):
+    """
+    Wrap a sync httpx transport the same way, for the Graph downloads made from worker threads.
+    """
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        attempts = self._attempts(request)
+        for attempt in range(1, attempts + 1):
+            try:
+                response = self._transport.handle_request(request)
+            except httpx.ConnectError:
+                if attempt == attempts:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning("Connection to %s failed, retrying in %.1fs (attempt %d of %d)", request.url.host, delay, attempt, attempts)
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or attempt == attempts:
+                    return response
+                delay = self._retry_delay(response, attempt)
+                response.close()
+                logger.warning("%s %s returned %d, retrying in %.1fs (attempt %d of %d)", request.method, request.url.path, response.status_code, delay, attempt, attempts)
+            time.sleep(delay)
+
+    def close(self) -> None:
+        self._transport.close()
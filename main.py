@@ -1,15 +1,48 @@
+import asyncio
 import datetime
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
 
-from fastapi import FastAPI
+import httpx
+
+from fastapi import Depends, FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi import BackgroundTasks, HTTPException
 
-from graph_tools import AzureAuth, update_drive_item_metadata, list_files_in_folder
-from uploader import build_presigned_put_url, upload_graph_file_to_s3, create_empty_folder, update_user_meta
+from http_retry import RetryTransport
+from graph_tools import GRAPH_BASE_URL, AzureAuth, update_drive_items_metadata, get_drive_item_ctags, list_folder_tree
+from upload_state import UploadStateStore
+from uploader import build_presigned_put_url, upload_graph_file_to_s3, create_empty_folder, create_folders_bulk, update_user_meta
 from pydantic import BaseModel
 from typing import List
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # A single HTTP/2 client shared by all Graph and Curate calls, so concurrent requests
+    # are multiplexed over pooled connections instead of opening new ones. Graph calls pass
+    # paths relative to the base URL; Curate calls use absolute URLs. Throttled (429) and
+    # transient 5xx responses are retried by the transport on the same connections
+    transport = RetryTransport(httpx.AsyncHTTPTransport(http2=True, limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)))
+    app.state.http = httpx.AsyncClient(base_url=GRAPH_BASE_URL, transport=transport)
+    # Shared by every request so the cached access token is reused until it nears expiry
+    app.state.auth = AzureAuth(TENANT_ID, CLIENT_ID, CLIENT_SECRET)
+    app.state.upload_state = UploadStateStore(UPLOAD_STATE_DB) if UPLOAD_STATE_DB else None
+    # Shared by all upload tasks, so concurrent packages don't each get their own quota of transfers
+    app.state.upload_semaphore = asyncio.Semaphore(UPLOAD_CONCURRENCY)
+    # Multipart transfers hold a thread for their whole duration, so they get their own bounded
+    # pool rather than queueing token mints, presigns and sqlite lookups on the default executor
+    app.state.transfer_executor = ThreadPoolExecutor(max_workers=LARGE_TRANSFER_WORKERS, thread_name_prefix="large-transfer")
+    yield
+    await app.state.http.aclose()
+    app.state.transfer_executor.shutdown(wait=False)
+    if app.state.upload_state:
+        app.state.upload_state.close()
+
+logger = logging.getLogger(__name__)
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS settings (if needed)
 app.add_middleware(
@@ -33,6 +66,20 @@ TENANT_ID = ""
 # TENANT_ID = os.environ.get('AZURE_TENANT_ID')
 
 
+# Maximum number of files transferred concurrently across all upload tasks
+UPLOAD_CONCURRENCY = int(os.getenv("UPLOAD_CONCURRENCY", "8"))
+
+# Maximum number of large (multipart) transfers running at once across all upload tasks
+LARGE_TRANSFER_WORKERS = int(os.getenv("LARGE_TRANSFER_WORKERS", "4"))
+
+# Attempts at writing the final PreservationStatus of each item back to SharePoint
+FINAL_STATUS_ATTEMPTS = 3
+
+# Optional sqlite database recording which file versions were already uploaded, so unchanged
+# files are skipped on re-runs. Unset by default, so every file is uploaded
+UPLOAD_STATE_DB = os.getenv("UPLOAD_STATE_DB", "")
+
+
 # Define the models
 
 class CurateDetails(BaseModel):
@@ -48,7 +95,7 @@ class UploadItem(BaseModel):
     spId: str
     driveId: str
     name: str
-    fileSize: str
+    fileSize: int
     type: str  # You can use an enum if the types are predefined, e.g., Enum("File", "Folder")
 
 class UserInfo(BaseModel):
@@ -64,79 +111,191 @@ class SharePointPackage(BaseModel):
 
 upload_container_name_format = lambda: f"SharePointUpload_{datetime.datetime.now().strftime('%Y%m%d%H%M%S')}"
 
-@app.post("/uploadSharePointPackage")
-async def upload_sharepoint_package(data: SharePointPackage, background_tasks: BackgroundTasks) -> dict:
+async def get_graph_token(auth: AzureAuth) -> str:
+    """
+    Get a Graph access token valid for at least TOKEN_REFRESH_BUFFER seconds.
+    Minting a token is a blocking HTTP call, so it runs off the event loop.
+    """
+    return await asyncio.to_thread(auth.get_access_token)
+
+
+async def get_token(request: Request) -> str:
+    """
+    Dependency providing a Microsoft Graph access token from the app's shared AzureAuth.
+    """
+    try:
+        return await get_graph_token(request.app.state.auth)
+    except Exception as e:
+        logger.error(f"Error getting access token: {str(e)}")
+        raise HTTPException(status_code=502, detail="Could not authenticate with Microsoft Graph.")
+
+
+# get_token only checks that a token can be obtained before accepting the upload; the background
+# task fetches its own tokens as it goes, since the upload can outlive any single token
+@app.post("/uploadSharePointPackage", dependencies=[Depends(get_token)])
+async def upload_sharepoint_package(request: Request, data: SharePointPackage, background_tasks: BackgroundTasks) -> dict:
     """
     Upload a SharePoint package to the upload container.
     """
     try:
-        background_tasks.add_task(upload_task, data)
+        background_tasks.add_task(upload_task, data, request.app.state.auth)
         return {"success": True, "message": "Upload task initiated successfully."}
     except Exception as e:
-        print(f"Error in upload_sharepoint_package: {str(e)}")
+        logger.error(f"Error in upload_sharepoint_package: {str(e)}")
         raise HTTPException(status_code=500, detail="An unexpected error occurred.")
 
 
-async def upload_task(data: SharePointPackage) -> None:
+async def upload_task(data: SharePointPackage, auth: AzureAuth) -> None:
     """
     Upload a SharePoint package to the upload container.
 
     Args:
         data (SharePointPackage): The validated SharePoint package data.
+        auth (AzureAuth): Source of access tokens for the SharePoint site, fetched before each Graph operation.
     """
-    try:
-        curate_details = data.curateDetails
-        sharepoint_details = data.sharepointDetails
-        upload_items = data.uploadItems
-        user_details = data.userInfo
+    curate_details = data.curateDetails
+    sharepoint_details = data.sharepointDetails
+    upload_items = data.uploadItems
+    user_details = data.userInfo
 
-        # Assuming you have these constants or you can inject them
-        auth_client = AzureAuth(CLIENT_ID, TENANT_ID, CLIENT_SECRET)
-        access_token = auth_client.get_access_token()
+    client = app.state.http
 
-        if not upload_items:
-            print("No items to upload.")
-            return
+    if not upload_items:
+        logger.info("No items to upload.")
+        return
 
+    try:
         container_folder_name = upload_container_name_format()
 
-        for item in upload_items:
-            try:
-                # Update metadata and process items
-                update_drive_item_metadata(sharepoint_details.siteId, item.driveId, item.spId, item.name, {"PreservationStatus": "Initiating"}, access_token)
-
-                if item.type == 'Folder':
-                    process_folder(sharepoint_details, curate_details, user_details, item, container_folder_name, access_token)
-                    status = "Success"
-                else:
-                    result = process_item(sharepoint_details, curate_details, user_details, item, None, access_token, container_folder_name)
-                    status = "Success" if result.get('success') else f"Failed: {result.get("error")}"
-                    if not result.get('success'):
-                        print(f"Error processing item {item.name}: {result.get('message')}")
-                
-                update_drive_item_metadata(sharepoint_details.siteId, item.driveId, item.spId, item.name, {"PreservationStatus": status}, access_token)
-            except Exception as e:
-                print(f"Error processing item {item.name}: {str(e)}")
-                update_drive_item_metadata(sharepoint_details.siteId, item.driveId, item.spId, item.name, {"PreservationStatus": f"Failed: {str(e)}"}, access_token)
-
-        print("All items processed.")
+        # Look up the current version of each file in the same pass as marking everything as initiating
+        file_items = [item for item in upload_items if item.type != 'Folder'] if app.state.upload_state else []
+        access_token = await get_graph_token(auth)
+        _, ctags = await asyncio.gather(
+            update_drive_items_metadata(client, sharepoint_details.siteId, [(item.driveId, item.spId, {"PreservationStatus": "Initiating"}) for item in upload_items], access_token),
+            get_drive_item_ctags(client, sharepoint_details.siteId, [(item.driveId, item.id) for item in file_items], access_token)
+        )
+        item_ctags = {(item.driveId, item.id): ctag for item, ctag in zip(file_items, ctags)}
+
+        semaphore = app.state.upload_semaphore
+        created_folders = {}
+
+        async def handle(item: UploadItem) -> str:
+            if item.type == 'Folder':
+                file_results = await process_folder(client, sharepoint_details, curate_details, user_details, item, container_folder_name, auth, semaphore, created_folders)
+                failed = [r for r in file_results if not r.get('success')]
+                if failed:
+                    return f"Failed: {len(failed)} of {len(file_results)} files"
+                if file_results and all(r.get('skipped') for r in file_results):
+                    return "Skipped: unchanged"
+                return "Success"
+            result = await process_item_if_changed(client, sharepoint_details, curate_details, user_details, item, None, auth, container_folder_name, created_folders, semaphore, item_ctags.get((item.driveId, item.id)))
+            if not result.get('success'):
+                logger.error(f"Error processing item {item.name}: {result.get('message')}")
+                return f"Failed: {result.get('message')}"
+            if result.get('skipped'):
+                return "Skipped: unchanged"
+            return "Success"
+
+        results = await asyncio.gather(*[handle(item) for item in upload_items], return_exceptions=True)
+
+        statuses = []
+        for item, result in zip(upload_items, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing item {item.name}: {str(result)}")
+                result = f"Failed: {str(result)}"
+            statuses.append(result)
     except Exception as e:
-        print(f"Error in upload_task: {str(e)}")
-        raise
+        logger.error(f"Error in upload_task: {str(e)}")
+        statuses = [f"Failed: {str(e)}" for _ in upload_items]
+
+    await write_final_statuses(client, sharepoint_details.siteId, upload_items, statuses, auth)
+    logger.info("All items processed.")
+
+
+async def write_final_statuses(client: httpx.AsyncClient, site_id: str, upload_items: List[UploadItem], statuses: List[str], auth: AzureAuth) -> None:
+    """
+    Write each item's final PreservationStatus back to SharePoint. Updates that fail, including
+    because no access token could be obtained, are retried, and any still failing are logged per item.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        site_id (str): The ID of the SharePoint site.
+        upload_items (List[UploadItem]): The items in the package.
+        statuses (List[str]): The final status of each item, in the same order.
+        auth (AzureAuth): Source of access tokens for the SharePoint site.
+    """
+    pending = list(zip(upload_items, statuses))
+    for attempt in range(1, FINAL_STATUS_ATTEMPTS + 1):
+        try:
+            # The uploads may have taken longer than any earlier token had left
+            access_token = await get_graph_token(auth)
+            results = await update_drive_items_metadata(client, site_id, [(item.driveId, item.spId, {"PreservationStatus": status}) for item, status in pending], access_token)
+        except Exception as e:
+            results = [{'success': False, 'error': str(e)} for _ in pending]
+
+        failed = [(update, result) for update, result in zip(pending, results) if not result.get('success')]
+        if not failed:
+            return
+        if attempt == FINAL_STATUS_ATTEMPTS:
+            for (item, status), result in failed:
+                logger.error(f"Could not write status {status!r} for item {item.name}: {result.get('error')}")
+            return
+        pending = [update for update, _ in failed]
+        logger.warning(f"Retrying {len(pending)} final status updates")
+        await asyncio.sleep(2 ** attempt)
+
+
+async def create_folder_once(client: httpx.AsyncClient, folder_path: str, curate_details: dict, created_folders: dict, user_meta: dict = None) -> str:
+    """
+    Create a folder in Curate the first time it is needed during an upload task and return its UUID.
+    Concurrent callers asking for the same path share a single create request.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        folder_path (str): Path of the folder, relative to the SharePoint uploads folder.
+        curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
+        created_folders (dict): Pending or finished folder creations for this upload task, keyed by path.
+        user_meta (dict, optional): User metadata to set on the folder once it has been created.
+
+    Returns:
+        str: The UUID of the folder.
+    """
+    if folder_path not in created_folders:
+        created_folders[folder_path] = asyncio.ensure_future(_create_folder(client, folder_path, curate_details, user_meta))
+    return await created_folders[folder_path]
+
+
+async def _create_folder(client: httpx.AsyncClient, folder_path: str, curate_details: dict, user_meta: dict) -> str:
+    r = await create_empty_folder(client, folder_path, curate_details)
+    if not r['success']:
+        raise Exception(f"Error creating folder {folder_path}: {r.get('error')}")
+
+    folder_uuid = r['data']['Children'][0]['Uuid']
+    if not folder_uuid:
+        raise Exception(f"Error creating folder {folder_path}: No UUID returned")
+
+    if user_meta:
+        r = await update_user_meta(client, folder_uuid, curate_details, user_meta)
+        if not r['success']:
+            raise Exception(f"Error updating user meta for {folder_path}: {r.get('error')}")
 
+    return folder_uuid
 
-def process_item(sharepoint_details: dict, curate_details: dict, user_details: dict, item: dict, folder: str, access_token: str, container_folder_name: str) -> dict:
+
+async def process_item(client: httpx.AsyncClient, sharepoint_details: dict, curate_details: dict, user_details: dict, item: dict, folder: str, auth: AzureAuth, container_folder_name: str, created_folders: dict) -> dict:
     """
     Process a single item in the SharePoint package.
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         sharepoint_details (dict): Contains 'siteId' and 'siteUrl' for the SharePoint site.
         curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
         user_details (dict): Contains 'name' and 'email' for the user.
         item (dict): Details of the item to process.
-        folder (str): Name of the folder where the item is located.
-        access_token (str): Access token for the SharePoint site.
+        folder (str): Path of the folder where the item is located, relative to the container folder.
+        auth (AzureAuth): Source of access tokens for the SharePoint site.
         container_folder_name (str): Name of the container folder where the item will be uploaded.
+        created_folders (dict): Folders already created during this upload task, keyed by path.
 
     Returns:
         dict: A dictionary containing:
@@ -146,76 +305,100 @@ def process_item(sharepoint_details: dict, curate_details: dict, user_details: d
     """
     try:
         # if file is larger than 10gb, reject it with message explaining you should use the Soteria+ command line client or sftp for uploads over 10gb.
-        if int(item.fileSize) > 1 * 1024 * 1024 * 1024:
+        if item.fileSize > 1 * 1024 * 1024 * 1024:
             raise Exception("File size is too large. Please use the Soteria+ command line client or sftp for uploads over 10gb.")
-        stream_url = f"https://graph.microsoft.com/v1.0/sites/{sharepoint_details.siteId}/drives/{item.driveId}/items/{item.id}/content"
-        r = create_empty_folder(container_folder_name, curate_details)
-        if not r['success']:
-            raise Exception(f"Error creating scoped upload folder: {r.get('message')}")
-
-        folder_uuid = r['data']['Children'][0]['Uuid']
-        if not folder_uuid:
-            raise Exception("Error creating scoped upload folder: No UUID returned")
-
-        r = update_user_meta(folder_uuid, curate_details, {"usermeta-contributor": f"{user_details.name}:{user_details.email}"})
-        if not r['success']:
-            raise Exception(f"Error updating user meta: {r.get('message')}")
+        stream_url = f"{GRAPH_BASE_URL}/sites/{sharepoint_details.siteId}/drives/{item.driveId}/items/{item.id}/content"
+        await create_folder_once(client, container_folder_name, curate_details, created_folders, {"usermeta-contributor": f"{user_details.name}:{user_details.email}"})
 
         path = f"{container_folder_name}/{folder}/{item.name}" if folder else f"{container_folder_name}/{item.name}"
         
 
-        upload_result = upload_graph_file_to_s3(stream_url, path, curate_details, access_token, item.fileSize)
+        access_token = await get_graph_token(auth)
+        upload_result = await upload_graph_file_to_s3(client, stream_url, path, curate_details, access_token, item.fileSize, app.state.transfer_executor)
 
         if not upload_result['success']:
             raise Exception(f"Upload failed: {upload_result.get('error')}")
 
         return {'success': True, 'item': upload_result['item']}
     except Exception as e:
-        print(f"Error in process_item: {str(e)}")
+        logger.error(f"Error in process_item: {str(e)}")
         return {'success': False, 'message': str(e)}
 
-def process_folder(sharepoint_details: dict, curate_details: dict, user_details: dict, folder_item: dict, container_folder_name: str, access_token: str) -> None:
+async def process_item_if_changed(client: httpx.AsyncClient, sharepoint_details: dict, curate_details: dict, user_details: dict, item: dict, folder: str, auth: AzureAuth, container_folder_name: str, created_folders: dict, semaphore: asyncio.Semaphore, ctag: str) -> dict:
+    """
+    Process a single item unless the same version was already uploaded to this Curate site,
+    and record the version once it has been uploaded.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        sharepoint_details (dict): Contains 'siteId' and 'siteUrl' for the SharePoint site.
+        curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
+        user_details (dict): Contains 'name' and 'email' for the user.
+        item (dict): Details of the item to process.
+        folder (str): Path of the folder where the item is located, relative to the container folder.
+        auth (AzureAuth): Source of access tokens for the SharePoint site.
+        container_folder_name (str): Name of the container folder where the item will be uploaded.
+        created_folders (dict): Folders already created during this upload task, keyed by path.
+        semaphore (asyncio.Semaphore): Bounds how many files are transferred at once.
+        ctag (str): cTag of the item's current content, or None if unknown.
+
+    Returns:
+        dict: The result of process_item, or {'success': True, 'skipped': True} if the item was unchanged.
+    """
+    upload_state = app.state.upload_state
+    if upload_state and ctag and await asyncio.to_thread(upload_state.is_uploaded, curate_details.siteUrl, item.driveId, item.id, ctag):
+        logger.info(f"Skipping unchanged item {item.name}")
+        return {'success': True, 'skipped': True}
+
+    async with semaphore:
+        result = await process_item(client, sharepoint_details, curate_details, user_details, item, folder, auth, container_folder_name, created_folders)
+
+    if upload_state and ctag and result.get('success'):
+        await asyncio.to_thread(upload_state.record_upload, curate_details.siteUrl, item.driveId, item.id, ctag)
+    return result
+
+async def process_folder(client: httpx.AsyncClient, sharepoint_details: dict, curate_details: dict, user_details: dict, folder_item: dict, container_folder_name: str, auth: AzureAuth, semaphore: asyncio.Semaphore, created_folders: dict) -> List[dict]:
     """
     Process a folder in the SharePoint package. Microsoft Graph doesn't support downloading
-    whole folders, so we need to recursively process each item in the folder.
+    whole folders, so we enumerate the whole folder tree first and then process each file in it.
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         sharepoint_details (dict): Contains 'siteId' and 'siteUrl' for the SharePoint site.
         curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
         user_details (dict): Contains 'name' and 'email' for the user.
         folder_item (dict): Details of the folder to process.
         container_folder_name (str): Name of the container folder where the folder will be uploaded.
-        access_token (str): Access token for the SharePoint site.
+        auth (AzureAuth): Source of access tokens for the SharePoint site.
+        semaphore (asyncio.Semaphore): Bounds how many files are transferred at once.
+        created_folders (dict): Folders already created during this upload task, keyed by path.
+
+    Returns:
+        List[dict]: The result of process_item_if_changed for each file in the folder tree.
     """
     try:
-        r = create_empty_folder(f"{container_folder_name}", curate_details)
+        await create_folder_once(client, container_folder_name, curate_details, created_folders, {"usermeta-contributor": f"{user_details.name}:{user_details.email}"})
+        access_token = await get_graph_token(auth)
+        folder_paths, files = await list_folder_tree(client, sharepoint_details.siteId, folder_item.driveId, folder_item.id, folder_item.name, access_token, UPLOAD_CONCURRENCY)
+
+        # Create the folder and all of its descendants in one request, including empty ones
+        r = await create_folders_bulk(client, [f"{container_folder_name}/{path}" for path in [folder_item.name] + folder_paths], curate_details)
         if not r['success']:
-            raise Exception(f"Error creating container folder: {r.get('message')}")
+            raise Exception(f"Error creating folders for {folder_item.name}: {r.get('error')}")
 
-        folder_uuid = r['data']['Children'][0]['Uuid']
-        if not folder_uuid:
-            raise Exception("Error creating container folder: No UUID returned")
+        async def process_file(folder_path: str, file: dict) -> dict:
+            item = UploadItem(id=file['id'], spId=file['id'], driveId=file['parentReference']['driveId'], name=file['name'], fileSize=file['size'], type='File')
+            return await process_item_if_changed(client, sharepoint_details, curate_details, user_details, item, folder_path, auth, container_folder_name, created_folders, semaphore, file.get('cTag'))
 
-        r = update_user_meta(folder_uuid, curate_details, {"usermeta-contributor": f"{user_details.name}:{user_details.email}"})
-        if not r['success']:
-            raise Exception(f"Error updating user meta for container folder: {r.get('message')}")
+        results = await asyncio.gather(*[process_file(folder_path, file) for folder_path, file in files], return_exceptions=True)
 
-        r = create_empty_folder(f"{container_folder_name}/{folder_item.name}", curate_details)
-        if not r['success']:
-            raise Exception(f"Error creating subfolder: {r.get('message')}")
-
-        folder_uuid = r['data']['Children'][0]['Uuid']
-        if not folder_uuid:
-            raise Exception("Error creating subfolder: No UUID returned")
-        print("ballsack: ", folder_item)
-        files = list_files_in_folder(sharepoint_details.siteId, folder_item.driveId, folder_item.id, access_token)
-        for file in files['value']:
-            if 'folder' in file and file['folder']['childCount'] > 0:
-                process_folder(sharepoint_details, curate_details, user_details, file, container_folder_name, access_token)
-            elif 'folder' not in file:
-                item = UploadItem(id=file['id'], spId=file['id'], driveId=file['parentReference']['driveId'], name=file['name'], type='File')
-                 
-                process_item(sharepoint_details, curate_details, user_details, item, folder_item.name, access_token, container_folder_name)
+        file_results = []
+        for (folder_path, file), result in zip(files, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error processing file {folder_path}/{file.get('name')}: {str(result)}")
+                result = {'success': False, 'message': str(result)}
+            file_results.append(result)
+        return file_results
     except Exception as e:
-        print(f"Error in process_folder: {str(e)}")
+        logger.error(f"Error in process_folder: {str(e)}")
         raise
\ No newline at end of file
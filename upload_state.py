@@ -0,0 +1,74 @@
+import sqlite3
+import threading
+
+class UploadStateStore:
+    """
+    Remember which version of each SharePoint file was last uploaded to each Curate site,
+    so re-running an upload can skip files whose content hasn't changed.
+
+    Versions are tracked by the drive item's cTag, which only changes when the file content
+    changes. The eTag would also change when we write PreservationStatus back to the item.
+
+    Attributes:
+    path (str): Path of the sqlite database file.
+    """
+    def __init__(self, path: str):
+        """
+        Initialize the UploadStateStore class, creating the database if it doesn't exist.
+
+        Args:
+            path (str): Path of the sqlite database file.
+        """
+        self.path = path
+        # Used from worker threads, so share one connection behind a lock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS uploads ("
+                "site_url TEXT NOT NULL, drive_id TEXT NOT NULL, item_id TEXT NOT NULL, ctag TEXT NOT NULL, "
+                "PRIMARY KEY (site_url, drive_id, item_id))"
+            )
+
+    def is_uploaded(self, site_url: str, drive_id: str, item_id: str, ctag: str) -> bool:
+        """
+        Check whether this version of a file has already been uploaded to a Curate site.
+
+        Args:
+            site_url (str): The Curate site the file is being uploaded to.
+            drive_id (str): The ID of the drive containing the file.
+            item_id (str): The ID of the file.
+            ctag (str): The cTag of the file's current version.
+
+        Returns:
+            bool: True if the same version was uploaded before.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM uploads WHERE site_url = ? AND drive_id = ? AND item_id = ? AND ctag = ?",
+                (site_url, drive_id, item_id, ctag)
+            ).fetchone()
+        return row is not None
+
+    def record_upload(self, site_url: str, drive_id: str, item_id: str, ctag: str) -> None:
+        """
+        Record that a version of a file was uploaded to a Curate site.
+
+        Args:
+            site_url (str): The Curate site the file was uploaded to.
+            drive_id (str): The ID of the drive containing the file.
+            item_id (str): The ID of the file.
+            ctag (str): The cTag of the uploaded version.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO uploads (site_url, drive_id, item_id, ctag) VALUES (?, ?, ?, ?)",
+                (site_url, drive_id, item_id, ctag)
+            )
+
+    def close(self) -> None:
+        """
+        Close the database connection. The store can't be used afterwards.
+        """
+        with self._lock:
+            self._connection.close()
@@ -1,11 +1,11 @@
-import os
-import tempfile
+import asyncio
+import functools
+from concurrent.futures import Executor
 import time
 import boto3
 from botocore.exceptions import BotoCoreError, ClientError
 import httpx
-import json
-import requests
+import orjson
 from urllib.parse import urljoin, quote
 from datetime import datetime
 import xml.etree.ElementTree as ET
@@ -22,21 +22,53 @@ from io import BytesIO
 import logging
 import io
 
+from graph_tools import _json
+from http_retry import SyncRetryTransport
+
 # Set up logging
 logging.basicConfig(level=None)
 logger = logging.getLogger(__name__)
 
-def upload_graph_file_to_s3(graph_file_url: str, curate_path: str, curate_details: dict, graph_access_token: str, file_size: str, multipart_threshold: int = 100 * 1024 * 1024) -> dict:
+
+# Sync client for the Graph downloads streamed into multipart uploads from worker threads,
+# retrying throttled and transient failures to open the download like the shared async client does
+_GRAPH_DOWNLOAD_CLIENT = httpx.Client(transport=SyncRetryTransport(httpx.HTTPTransport()))
+
+
+@functools.lru_cache(maxsize=8)
+def _s3_client(endpoint_url: str, access_key: str, region_name: str = None):
+    """
+    Get a cached S3 client for a Curate gateway. Building a client loads the botocore
+    service model and resolves the endpoint, so clients are reused across uploads.
+    boto3 clients are thread-safe, so one client can serve concurrent transfers.
     """
-    Transfer a file from the graph api to Curate. Uses streaming for files under multipart threshold,
-    for files over multipart threshold it uses standard download/upload pattern
+    config = Config(
+        signature_version='s3v4',
+        s3={'addressing_style': 'path'},
+        max_pool_connections=64
+    )
+    return boto3.session.Session().client(
+        's3',
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key,
+        aws_secret_access_key='gatewaysecret',
+        region_name=region_name,
+        config=config
+    )
+
+async def upload_graph_file_to_s3(client: httpx.AsyncClient, graph_file_url: str, curate_path: str, curate_details: dict, graph_access_token: str, file_size: int, executor: Executor = None, multipart_threshold: int = 100 * 1024 * 1024) -> dict:
+    """
+    Transfer a file from the graph api to Curate. Uses a single streamed PUT for files under multipart threshold,
+    for files over multipart threshold it streams into a multipart upload
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         graph_file_url (str): The URL of the file in Graph API.
         s3_presigned_data (dict): Contains 'url', 'headers', and 'path' for S3 upload.
         graph_access_token (str): Access token for Graph API.
         curate_access_token (str): API key for the Curate instance
-        file_size (str): Size of the file to transfer in bytes. 
+        file_size (int): Size of the file to transfer in bytes.
+        executor (Executor, optional): Runs the blocking multipart upload; defaults to the event loop's default executor.
         multipart_threshold (int): File size threshold for multipart upload (default is 100MB).
         
 
@@ -52,24 +84,70 @@ def upload_graph_file_to_s3(graph_file_url: str, curate_path: str, curate_detail
         'Accept': 'application/octet-stream'
     }
     
-    if int(file_size) >= multipart_threshold:
-        return upload_large_graph_file_to_s3(graph_file_url,  graph_access_token, curate_path, curate_details)
+    if file_size >= multipart_threshold:
+        # boto3's multipart upload is blocking, so keep it off the event loop
+        return await asyncio.get_running_loop().run_in_executor(executor, upload_large_graph_file_to_s3, graph_file_url, graph_access_token, curate_path, curate_details)
     else:
-        s3_presigned_data = build_presigned_put_url(curate_path, curate_details)
+        # Presign the S3 PUT while the Graph download is being opened, rather than one after the other.
+        # Presigning is local, but the first call per gateway builds the boto3 client
+        graph_request = client.build_request('GET', graph_file_url, headers=graph_headers)
+        s3_presigned_data, graph_response = await asyncio.gather(
+            asyncio.to_thread(build_presigned_put_url, curate_path, curate_details),
+            client.send(graph_request, stream=True, follow_redirects=True),
+            return_exceptions=True
+        )
         try:
-            
-            with httpx.stream('GET', graph_file_url, headers=graph_headers, follow_redirects=True) as graph_response:
-                return stream_graph_file_to_s3(graph_response, s3_presigned_data)
-
-        except httpx.HTTPStatusError as e:
-            print(f"HTTP error in stream_graph_file_to_s3: {e}")
-            return {'success': False, 'error': str(e), 'item': s3_presigned_data['path']}
+            if isinstance(graph_response, BaseException):
+                raise graph_response
+            if isinstance(s3_presigned_data, BaseException):
+                raise s3_presigned_data
+            graph_response.raise_for_status()
+            return await stream_graph_file_to_s3(client, graph_response, s3_presigned_data, file_size)
+
+        except httpx.HTTPError as e:
+            logger.error(f"HTTP error in stream_graph_file_to_s3: {e}")
+            return {'success': False, 'error': str(e), 'item': curate_path}
+        finally:
+            if isinstance(graph_response, httpx.Response):
+                await graph_response.aclose()
+
+
+class _HttpxStreamReader(io.RawIOBase):
+    """
+    Read-only, non-seekable file object over a streaming httpx response, so boto3 can
+    consume a Graph download part by part instead of needing the whole body up front.
+    """
+    def __init__(self, response: httpx.Response):
+        self._chunks = response.iter_bytes()
+        self._buffer = b''
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        # Fill the whole buffer unless the stream ends, since boto3 treats a short
+        # read as the final multipart part
+        view = memoryview(b).cast('B')
+        written = 0
+        while written < len(view):
+            if not self._buffer:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer = chunk
+                continue
+            n = min(len(view) - written, len(self._buffer))
+            view[written:written + n] = self._buffer[:n]
+            self._buffer = self._buffer[n:]
+            written += n
+        return written
 
 
 def upload_large_graph_file_to_s3(graph_file_url: str, graph_access_token: str, curate_path: str, curate_details: dict) -> dict:
     """
-    Uploads a large graph file to S3 using multipart uploads 
-    Downloads the file first and then uploads (no streaming)
+    Uploads a large graph file to S3 using multipart uploads.
+    The Graph download is streamed straight into the multipart upload, so only a few parts
+    are held in memory at once and nothing is written to disk.
 
     Args:
         graph_file_url (str): The URL of the file in Graph API.
@@ -78,53 +156,28 @@ def upload_large_graph_file_to_s3(graph_file_url: str, graph_access_token: str,
         curate_details (dict): Contains 'siteUrl' and 'apiKey' for S3 upload.
     """
     try:
-        print("multi upload details: ", graph_file_url, curate_path, curate_details)
+        logger.debug("Multipart upload of %s to %s", graph_file_url, curate_path)
 
         bucket = "io"
         key = f"quarantine/SharePoint Uploads/{curate_path}"
-        endpoint_url = f"https://{curate_details.siteUrl}"
-
-        headers = {'Authorization': f'Bearer {graph_access_token}'}
-        graph_response = requests.get(graph_file_url, headers=headers)
-        graph_response.raise_for_status()
-
-        total_file_size = len(graph_response.content)
-        logger.info(f"File size from Graph API: {total_file_size}")
-
-        if total_file_size == 0:
-            raise ValueError("File size is 0")
-
-        with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-            temp_file.write(graph_response.content)
-            temp_file_path = temp_file.name
-            temp_file.flush()
-            os.fsync(temp_file.fileno())
-
-        if os.path.getsize(temp_file_path) != total_file_size:
-            raise ValueError(f"File size mismatch: expected {total_file_size}, got {os.path.getsize(temp_file_path)}")
-
-        config = Config(
-            signature_version='s3v4',
-            s3={'addressing_style': 'path'}
-        )
-        s3_client = boto3.client(
-            's3',
-            endpoint_url=endpoint_url,
-            aws_access_key_id=curate_details.apiKey,
-            aws_secret_access_key='gatewaysecret',
-            config=config
+        s3_client = _s3_client(f"https://{curate_details.siteUrl}", curate_details.apiKey)
+        transfer_config = TransferConfig(
+            multipart_threshold=8 * 1024 * 1024,
+            multipart_chunksize=8 * 1024 * 1024,
+            max_concurrency=4
         )
 
-        with open(temp_file_path, 'rb') as file_data:
-            s3_client.put_object(
+        headers = {'Authorization': f'Bearer {graph_access_token}'}
+        with _GRAPH_DOWNLOAD_CLIENT.stream('GET', graph_file_url, headers=headers, follow_redirects=True) as graph_response:
+            graph_response.raise_for_status()
+            s3_client.upload_fileobj(
+                _HttpxStreamReader(graph_response),
                 Bucket=bucket,
                 Key=key,
-                Body=file_data,
-                ContentType='application/octet-stream'
+                ExtraArgs={'ContentType': 'application/octet-stream'},
+                Config=transfer_config
             )
 
-        os.unlink(temp_file_path)
-
         logger.info(f"Upload completed successfully for {key}")
         return {'success': True, 'status': 200, 'item': curate_path}
 
@@ -133,24 +186,26 @@ def upload_large_graph_file_to_s3(graph_file_url: str, graph_access_token: str,
         return {'success': False, 'status': 500, 'error': str(e), 'item': curate_path}
 
 
-
-def stream_graph_file_to_s3(graph_response: httpx.Response, s3_presigned_data: dict) -> dict:
+async def stream_graph_file_to_s3(client: httpx.AsyncClient, graph_response: httpx.Response, s3_presigned_data: dict, file_size: int) -> dict:
     """
     Stream a file from Graph API to S3 using single-part upload.
+    The Content-Length comes from the item's known size, because Graph may send the
+    download chunked without one, and the body is sent decoded, so a compressed
+    download's own Content-Length wouldn't match it.
     """
     try:
         s3_url = s3_presigned_data['url']
-        s3_headers = s3_presigned_data['headers']
-        s3_headers['Content-Length'] = graph_response.headers.get('Content-Length', '0')
+        s3_headers = dict(s3_presigned_data['headers'])
+        s3_headers['Content-Length'] = str(file_size)
 
-        with httpx.stream('PUT', s3_url, data=graph_response.iter_bytes(), headers=s3_headers) as s3_response:
+        async with client.stream('PUT', s3_url, content=graph_response.aiter_bytes(), headers=s3_headers) as s3_response:
             s3_response.raise_for_status()
             return {'success': True, 'status': s3_response.status_code, 'item': s3_presigned_data['path']}
     except httpx.HTTPStatusError as e:
-        print(f"HTTP error in stream_graph_file_to_s3: {e}")
+        logger.error(f"HTTP error in stream_graph_file_to_s3: {e}")
         return {'success': False, 'error': str(e), 'item': s3_presigned_data['path']}
     except httpx.RequestError as e:
-        print(f"Request error in stream_graph_file_to_s3: {e}")
+        logger.error(f"Request error in stream_graph_file_to_s3: {e}")
         return {'success': False, 'error': str(e), 'item': s3_presigned_data['path']}
     
     
@@ -181,11 +236,7 @@ def build_presigned_put_url(path: str, curate_details: dict, user_meta: dict = {
         'Metadata': user_meta
     }
 
-    s3 = boto3.client('s3', 
-                      aws_access_key_id='gateway', 
-                      aws_secret_access_key='gatewaysecret', 
-                      region_name='eu-west-1', 
-                      endpoint_url=f"https://{curate_details.siteUrl}")
+    s3 = _s3_client(f"https://{curate_details.siteUrl}", 'gateway', 'eu-west-1')
     try:
         signed_url = s3.generate_presigned_url('put_object', Params=params, ExpiresIn=3600)
         return {
@@ -197,17 +248,35 @@ def build_presigned_put_url(path: str, curate_details: dict, user_meta: dict = {
             }
         }
     except (BotoCoreError, ClientError) as e:
-        print(f"Error generating presigned URL: {e}")
+        logger.error(f"Error generating presigned URL: {e}")
         raise
 
-def create_empty_folder(folder_name: str, curate_details: dict) -> dict:
+async def create_empty_folder(client: httpx.AsyncClient, folder_name: str, curate_details: dict) -> dict:
     """
     Create an empty folder in the specified path.
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         folder_name (str): Name of the folder to be created.
         curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
 
+    Returns:
+        dict: A dictionary containing:
+            - 'success' (bool): Whether the operation was successful.
+            - 'data' (dict): Response data from the API (if successful).
+            - 'error' (str): Error message (if unsuccessful).
+    """
+    return await create_folders_bulk(client, [folder_name], curate_details)
+
+async def create_folders_bulk(client: httpx.AsyncClient, paths: list, curate_details: dict) -> dict:
+    """
+    Create several folders with a single request, along with any missing parent folders.
+
+    Args:
+        client (httpx.AsyncClient): The shared HTTP client.
+        paths (list): Paths of the folders to be created, relative to the SharePoint uploads folder.
+        curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
+
     Returns:
         dict: A dictionary containing:
             - 'success' (bool): Whether the operation was successful.
@@ -221,27 +290,24 @@ def create_empty_folder(folder_name: str, curate_details: dict) -> dict:
     }
     
     body = {
-        "Nodes": [
-            {
-                "Path": f"quarantine/SharePoint Uploads/{folder_name}"
-            }
-        ],
+        "Nodes": [{"Path": f"quarantine/SharePoint Uploads/{path}"} for path in paths],
         "Recursive": True
     }
     
     try:
-        response = requests.post(url, headers=headers, json=body)
+        response = await client.post(url, headers=headers, content=orjson.dumps(body))
         response.raise_for_status()
-        return {'success': True, 'data': response.json()}
-    except requests.RequestException as e:
-        print(f"Error in create_empty_folder: {str(e)}")
+        return {'success': True, 'data': _json(response)}
+    except httpx.HTTPError as e:
+        logger.error(f"Error in create_folders_bulk: {str(e)}")
         return {'success': False, 'error': str(e)}
 
-def update_user_meta(node_uuid: str, curate_details: dict, namespace_value_pairs: dict) -> dict:
+async def update_user_meta(client: httpx.AsyncClient, node_uuid: str, curate_details: dict, namespace_value_pairs: dict) -> dict:
     """
     Update user metadata for a specific node.
 
     Args:
+        client (httpx.AsyncClient): The shared HTTP client.
         node_uuid (str): UUID of the node to update.
         curate_details (dict): Contains 'siteUrl' and 'apiKey' for the Curate site.
         namespace_value_pairs (dict): Key-value pairs of namespaces and their values to update.
@@ -275,9 +341,9 @@ def update_user_meta(node_uuid: str, curate_details: dict, namespace_value_pairs
     headers = {"Content-Type": "application/json", "Authorization": f"Bearer {curate_details.apiKey}"}
     
     try:
-        response = requests.put(url, json=body, headers=headers)
+        response = await client.put(url, content=orjson.dumps(body), headers=headers)
         response.raise_for_status()
-        return {'success': True, 'data': response.json()}
-    except requests.RequestException as e:
-        print(f"Error in update_user_meta: {str(e)}")
+        return {'success': True, 'data': _json(response)}
+    except httpx.HTTPError as e:
+        logger.error(f"Error in update_user_meta: {str(e)}")
         return {'success': False, 'error': str(e)}
\ No newline at end of file